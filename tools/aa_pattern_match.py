@@ -5,6 +5,7 @@
 
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
+from concurrent.futures import ProcessPoolExecutor
 import os
 import sys
 
@@ -28,24 +29,58 @@ KANJI_SET = """
 光影陰陽明暗昼夜朝晩
 """
 
-KANJI_LIST = list(set(KANJI_SET.replace('\n', '').replace(' ', '')))
-print(f"漢字セット: {len(KANJI_LIST)}文字")
+KANJI_LIST = list(dict.fromkeys(KANJI_SET.replace('\n', '').replace(' ', '')))
 
 
-def create_char_bitmap(char, size, font):
-    """文字を二値ビットマップに変換"""
+# 8bit値ごとの立っているビット数（np.bitwise_count が無い NumPy 用）
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def pack_bits(bitmaps):
+    """ビットマップ (..., H, W) を64ビット単位に詰める → (..., ceil(H*W/64)) の uint64"""
+    flat = bitmaps.reshape(*bitmaps.shape[:-2], -1)
+    packed = np.packbits(flat, axis=-1)
+    pad = -packed.shape[-1] % 8
+    if pad:
+        packed = np.pad(packed, [(0, 0)] * (packed.ndim - 1) + [(0, pad)])
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def count_bits(words):
+    """最後の軸ごとに立っているビット数を数える（popcount）"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def resize_nearest(bitmap, shape):
+    """最近傍法でリサイズ（PILのNEARESTと同じく画素中心でサンプリング）"""
+    rows = (2 * np.arange(shape[0]) + 1) * bitmap.shape[0] // (2 * shape[0])
+    cols = (2 * np.arange(shape[1]) + 1) * bitmap.shape[1] // (2 * shape[1])
+    return bitmap.take(rows, axis=0).take(cols, axis=1)
+
+
+def create_char_bitmaps(chars, size, font):
+    """文字列を二値ビットマップ (N, size, size) に変換"""
+    # 描画用の画像は1枚だけ作り、文字ごとに塗りつぶして使い回す
     img = Image.new('L', (size, size), 0)  # 黒背景
     draw = ImageDraw.Draw(img)
 
-    # 文字を中央に配置
-    bbox = draw.textbbox((0, 0), char, font=font)
-    w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
-    x = (size - w) // 2 - bbox[0]
-    y = (size - h) // 2 - bbox[1]
-    draw.text((x, y), char, font=font, fill=255)  # 白で描画
+    bitmaps = np.empty((len(chars), size, size), dtype=bool)
+    for i, char in enumerate(chars):
+        img.paste(0, (0, 0, size, size))
+
+        # 文字を中央に配置
+        bbox = draw.textbbox((0, 0), char, font=font)
+        w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        x = (size - w) // 2 - bbox[0]
+        y = (size - h) // 2 - bbox[1]
+        draw.text((x, y), char, font=font, fill=255)  # 白で描画
+
+        # 二値化
+        bitmaps[i] = np.array(img) > 128
 
-    # 二値化
-    return np.array(img) > 128
+    return bitmaps
 
 
 def load_font(size):
@@ -62,12 +97,18 @@ def load_font(size):
     return ImageFont.load_default()
 
 
-def pattern_match(cell, char_bitmaps):
-    """セルと最もマッチする漢字を探す"""
-    best_char = '　'
-    best_score = -1
+def pattern_match(cell, chars, packed_bitmaps, white_ratios, bitmap_shape):
+    """セルと最もマッチする漢字を探す
 
-    cell_white_ratio = cell.mean()
+    Args:
+        cell: 二値化済みのセル
+        chars: 候補の漢字リスト（packed_bitmapsの並びと対応）
+        packed_bitmaps: 全候補のビットマップをpack_bitsで詰めたもの (N, words)
+        white_ratios: 各ビットマップの白の割合 (N,)
+        bitmap_shape: 候補ビットマップの (H, W)
+    """
+    # bool の平均を float64 で集計せず、白画素数を整数で数えて割る
+    cell_white_ratio = np.count_nonzero(cell) / cell.size
 
     # ほぼ真っ黒ならスペース
     if cell_white_ratio < 0.02:
@@ -77,33 +118,43 @@ def pattern_match(cell, char_bitmaps):
     if cell_white_ratio > 0.95:
         return '■'
 
-    for char, bitmap in char_bitmaps.items():
-        if char in ['　', '■']:
-            continue
+    # リサイズ（全候補で同じサイズなので一度だけ）
+    if cell.shape != bitmap_shape:
+        cell_resized = resize_nearest(cell, bitmap_shape)
+    else:
+        cell_resized = cell
 
-        # リサイズ
-        if cell.shape != bitmap.shape:
-            cell_resized = np.array(
-                Image.fromarray(cell.astype(np.uint8) * 255)
-                .resize(bitmap.shape[::-1], Image.NEAREST)
-            ) > 128
-        else:
-            cell_resized = cell
+    # XNORで一致率計算（全候補を一括）
+    # 不一致数 = XORして立っているビット数（64画素ずつ処理）
+    size = cell_resized.size
+    mismatches = count_bits(packed_bitmaps ^ pack_bits(cell_resized))
+    matches = (size - mismatches) / size
 
-        # XNORで一致率計算
-        match = np.mean(cell_resized == bitmap)
+    # 白の割合も考慮
+    ratio_penalties = np.abs(cell_white_ratio - white_ratios) * 0.3
 
-        # 白の割合も考慮
-        bitmap_white_ratio = bitmap.mean()
-        ratio_penalty = abs(cell_white_ratio - bitmap_white_ratio) * 0.3
+    scores = matches - ratio_penalties
 
-        score = match - ratio_penalty
+    return chars[int(np.argmax(scores))]
 
-        if score > best_score:
-            best_score = score
-            best_char = char
 
-    return best_char
+# ワーカープロセスが使う候補データ（initializerで1回だけ受け取り、行ごとに送らない）
+_worker_candidates = {}
+
+
+def init_worker(chars, packed_bitmaps, white_ratios, bitmap_shape):
+    """ワーカープロセスの初期化"""
+    _worker_candidates.update(
+        chars=chars,
+        packed_bitmaps=packed_bitmaps,
+        white_ratios=white_ratios,
+        bitmap_shape=bitmap_shape,
+    )
+
+
+def match_row(row_cells):
+    """1行分のセル (列, H, W) をマッチングして文字列にする"""
+    return ''.join(pattern_match(cell, **_worker_candidates) for cell in row_cells)
 
 
 def main():
@@ -111,6 +162,7 @@ def main():
     output_width = int(sys.argv[2]) if len(sys.argv) > 2 else 200
     output_height = int(sys.argv[3]) if len(sys.argv) > 3 else 200
 
+    print(f"漢字セット: {len(KANJI_LIST)}文字")
     print(f"入力: {input_path}")
     print(f"出力サイズ: {output_width}x{output_height}文字")
 
@@ -129,37 +181,32 @@ def main():
     font = load_font(char_size)
 
     print(f"漢字ビットマップ生成中... (サイズ: {char_size}x{char_size})")
-    char_bitmaps = {}
-    for char in KANJI_LIST:
-        char_bitmaps[char] = create_char_bitmap(char, char_size, font)
-
-    # 特殊文字
-    char_bitmaps['　'] = np.zeros((char_size, char_size), dtype=bool)
-    char_bitmaps['■'] = np.ones((char_size, char_size), dtype=bool)
+    # 全候補を (N, H, W) の配列にまとめる
+    chars = KANJI_LIST
+    bitmap_stack = create_char_bitmaps(chars, char_size, font)
+    packed_bitmaps = pack_bits(bitmap_stack)
+    white_ratios = np.count_nonzero(bitmap_stack, axis=(1, 2)) / (char_size * char_size)
 
     print("AA生成中...")
     result = []
-    for row in range(output_height):
-        line = ""
-        for col in range(output_width):
-            y1 = row * cell_h
-            y2 = min(y1 + cell_h, h)
-            x1 = col * cell_w
-            x2 = min(x1 + cell_w, w)
-
-            cell = img[y1:y2, x1:x2]
-
-            if cell.size == 0:
-                line += '　'
-                continue
-
-            char = pattern_match(cell, char_bitmaps)
-            line += char
-
-        result.append(line)
-
-        if (row + 1) % 20 == 0:
-            print(f"進捗: {row + 1}/{output_height}行")
+    if cell_h == 0 or cell_w == 0:
+        result = ['　' * output_width] * output_height
+    else:
+        # 画像を (行, 列, cell_h, cell_w) のセルに分割（コピーなしのビュー）
+        cells = img[:output_height * cell_h, :output_width * cell_w].reshape(
+            output_height, cell_h, output_width, cell_w
+        ).swapaxes(1, 2)
+
+        # 各行は独立なので、行単位でCPUコアに振り分ける
+        with ProcessPoolExecutor(
+            initializer=init_worker,
+            initargs=(chars, packed_bitmaps, white_ratios, bitmap_stack.shape[1:]),
+        ) as executor:
+            for row, line in enumerate(executor.map(match_row, cells)):
+                result.append(line)
+
+                if (row + 1) % 20 == 0:
+                    print(f"進捗: {row + 1}/{output_height}行")
 
     aa_text = '\n'.join(result)
 
@@ -1,19 +1,29 @@
 #!/usr/bin/env python3
 import numpy as np
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 
 # Sobel mag読み込み
 img = np.array(Image.open('docs/images/kirinuki_indo_sobel_mag.png'))
 print(f'値の範囲: {img.min()} - {img.max()}')
 print(f'平均: {img.mean():.1f}')
 
-# 複数の閾値で二値化
+# 複数の閾値で一括二値化（画像は1回だけ走査して (H, W, 閾値数) のマスクを作る）
 thresholds = [1, 3, 5, 10, 15, 20, 30]
-for t in thresholds:
-    binary = (img >= t).astype(np.uint8) * 255
-    path = f'docs/images/kirinuki_indo_sobel_binary_{t}.png'
-    Image.fromarray(binary).save(path)
-    white_ratio = (img >= t).mean() * 100
-    print(f'閾値 {t:2d}: 白の割合 {white_ratio:.1f}% -> {path}')
+masks = img[..., None] >= np.array(thresholds)
+white_ratios = masks.mean(axis=(0, 1)) * 100
+
+
+def save_binary(i):
+    path = f'docs/images/kirinuki_indo_sobel_binary_{thresholds[i]}.png'
+    Image.fromarray(masks[..., i].astype(np.uint8) * 255).save(path)
+    return path
+
+
+# PNGエンコードはGILを解放するので並列に書き出す
+with ThreadPoolExecutor() as executor:
+    paths = executor.map(save_binary, range(len(thresholds)))
+    for t, white_ratio, path in zip(thresholds, white_ratios, paths):
+        print(f'閾値 {t:2d}: 白の割合 {white_ratio:.1f}% -> {path}')
 
 print('完了!')
@@ -5,7 +5,9 @@
 """
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from PIL import Image
+from scipy import ndimage
 import os
 import sys
 
@@ -17,32 +19,21 @@ def load_image(path):
     if img.mode == 'RGBA':
         alpha = np.array(img.split()[3])
         img_gray = img.convert('RGB').convert('L')
-        img_array = np.array(img_gray, dtype=np.float64)
+        img_array = np.array(img_gray, dtype=np.float32)
         # 透明部分を白に
         img_array = np.where(alpha < 128, 255, img_array)
     else:
-        img_array = np.array(img.convert('L'), dtype=np.float64)
+        img_array = np.array(img.convert('L'), dtype=np.float32)
 
     return img_array
 
 
 def sobel_edge(img):
     """Sobel演算子によるエッジ検出"""
-    # カーネル
-    Gx = np.array([[-1, 0, 1],
-                   [-2, 0, 2],
-                   [-1, 0, 1]], dtype=np.float64)
-
-    Gy = np.array([[-1, -2, -1],
-                   [ 0,  0,  0],
-                   [ 1,  2,  1]], dtype=np.float64)
-
-    # 畳み込み
-    edge_x = convolve(img, Gx)
-    edge_y = convolve(img, Gy)
+    edge_x, edge_y = sobel_gradient(img)
 
     # 合成（マグニチュード）
-    magnitude = np.sqrt(edge_x**2 + edge_y**2)
+    magnitude = np.hypot(edge_x, edge_y)
 
     # 方向（-π〜πをラジアンで）
     direction = np.arctan2(edge_y, edge_x)
@@ -61,13 +52,9 @@ def canny_edge(img, low_threshold=50, high_threshold=150):
     blurred = gaussian_blur(img, sigma=1.4)
 
     # 2. Sobelでグラディエント
-    Gx = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]], dtype=np.float64)
-    Gy = np.array([[-1, -2, -1], [0, 0, 0], [1, 2, 1]], dtype=np.float64)
-
-    edge_x = convolve(blurred, Gx)
-    edge_y = convolve(blurred, Gy)
+    edge_x, edge_y = sobel_gradient(blurred)
 
-    magnitude = np.sqrt(edge_x**2 + edge_y**2)
+    magnitude = np.hypot(edge_x, edge_y)
     direction = np.arctan2(edge_y, edge_x)
 
     # 3. Non-maximum suppression
@@ -79,7 +66,7 @@ def canny_edge(img, low_threshold=50, high_threshold=150):
     return {
         'blurred': normalize(blurred),
         'nms': normalize(nms),
-        'result': result.astype(np.float64) * 255
+        'result': result.astype(np.uint8) * 255
     }
 
 
@@ -91,12 +78,12 @@ def laplacian_edge(img):
     # 4近傍Laplacian
     kernel_4 = np.array([[ 0, -1,  0],
                          [-1,  4, -1],
-                         [ 0, -1,  0]], dtype=np.float64)
+                         [ 0, -1,  0]], dtype=np.float32)
 
     # 8近傍Laplacian
     kernel_8 = np.array([[-1, -1, -1],
                          [-1,  8, -1],
-                         [-1, -1, -1]], dtype=np.float64)
+                         [-1, -1, -1]], dtype=np.float32)
 
     lap_4 = convolve(blurred, kernel_4)
     lap_8 = convolve(blurred, kernel_8)
@@ -107,40 +94,59 @@ def laplacian_edge(img):
     }
 
 
-def dog_edge(img, sigma1=1.0, sigma2=2.0):
-    """Difference of Gaussians"""
+def dog_edge(img, sigma1=1.0, sigma2=2.0, multi_scale=False):
+    """Difference of Gaussians
+
+    multi_scale=True のときは sigma2 と sigma2*2 のDoGも計算する
+    """
     blur1 = gaussian_blur(img, sigma1)
     blur2 = gaussian_blur(img, sigma2)
 
     dog = blur1 - blur2
 
-    # 複数のスケールも試す
-    blur3 = gaussian_blur(img, sigma2 * 2)
-    dog2 = blur2 - blur3
-
-    return {
+    result = {
         f'sigma_{sigma1}_{sigma2}': normalize(np.abs(dog)),
-        f'sigma_{sigma2}_{sigma2*2}': normalize(np.abs(dog2)),
         'blur1': normalize(blur1),
         'blur2': normalize(blur2)
     }
 
+    # 複数のスケールも試す
+    if multi_scale:
+        blur3 = gaussian_blur(img, sigma2 * 2)
+        dog2 = blur2 - blur3
+        result[f'sigma_{sigma2}_{sigma2*2}'] = normalize(np.abs(dog2))
+
+    return result
+
 
 def convolve(img, kernel):
     """2D畳み込み"""
-    h, w = img.shape
     kh, kw = kernel.shape
     pad_h, pad_w = kh // 2, kw // 2
 
     # ゼロパディング
     padded = np.pad(img, ((pad_h, pad_h), (pad_w, pad_w)), mode='edge')
 
-    result = np.zeros_like(img)
-    for i in range(h):
-        for j in range(w):
-            result[i, j] = np.sum(padded[i:i+kh, j:j+kw] * kernel)
+    # 全画素の近傍をビューとして取り出し、一括で積和
+    windows = sliding_window_view(padded, (kh, kw))
+    return np.einsum('ijkl,kl->ij', windows, kernel)
 
-    return result
+
+def sobel_gradient(img):
+    """Sobelのx/y方向グラディエント
+
+    Sobelカーネルは [1,2,1] (平滑化) と [-1,0,1] (微分) の外積なので、
+    3x3の畳み込みを1Dの2回に分解して計算する
+    """
+    smooth = np.array([1, 2, 1], dtype=np.float32)
+    diff = np.array([-1, 0, 1], dtype=np.float32)
+
+    # Gx: 縦に平滑化 → 横に微分
+    edge_x = convolve(convolve(img, smooth[:, None]), diff[None, :])
+    # Gy: 横に平滑化 → 縦に微分
+    edge_y = convolve(convolve(img, smooth[None, :]), diff[:, None])
+
+    return edge_x, edge_y
 
 
 def gaussian_blur(img, sigma):
@@ -150,73 +156,66 @@ def gaussian_blur(img, sigma):
         size += 1
 
     x = np.arange(size) - size // 2
-    kernel_1d = np.exp(-x**2 / (2 * sigma**2))
+    kernel_1d = np.exp(-x**2 / (2 * sigma**2)).astype(np.float32)
     kernel_1d /= kernel_1d.sum()
 
-    # 分離可能カーネルとして適用
-    kernel_2d = np.outer(kernel_1d, kernel_1d)
-
-    return convolve(img, kernel_2d)
+    # 分離可能カーネルとして横→縦の1Dで2回適用
+    tmp = convolve(img, kernel_1d[None, :])
+    return convolve(tmp, kernel_1d[:, None])
 
 
 def non_max_suppression(magnitude, direction):
     """Non-maximum suppression"""
-    h, w = magnitude.shape
     result = np.zeros_like(magnitude)
 
     # 方向を0, 45, 90, 135度に量子化
     angle = direction * 180 / np.pi
     angle[angle < 0] += 180
-
-    for i in range(1, h-1):
-        for j in range(1, w-1):
-            q, r = 255, 255
-
-            # 0度方向（水平エッジ）
-            if (0 <= angle[i,j] < 22.5) or (157.5 <= angle[i,j] <= 180):
-                q = magnitude[i, j+1]
-                r = magnitude[i, j-1]
-            # 45度方向
-            elif 22.5 <= angle[i,j] < 67.5:
-                q = magnitude[i+1, j-1]
-                r = magnitude[i-1, j+1]
-            # 90度方向（垂直エッジ）
-            elif 67.5 <= angle[i,j] < 112.5:
-                q = magnitude[i+1, j]
-                r = magnitude[i-1, j]
-            # 135度方向
-            elif 112.5 <= angle[i,j] < 157.5:
-                q = magnitude[i-1, j-1]
-                r = magnitude[i+1, j+1]
-
-            if magnitude[i,j] >= q and magnitude[i,j] >= r:
-                result[i,j] = magnitude[i,j]
+    a = angle[1:-1, 1:-1]
+
+    # 内側の画素に対する8近傍（外周1画素は常に0）
+    center = magnitude[1:-1, 1:-1]
+    up, down = magnitude[:-2, 1:-1], magnitude[2:, 1:-1]
+    left, right = magnitude[1:-1, :-2], magnitude[1:-1, 2:]
+    up_left, up_right = magnitude[:-2, :-2], magnitude[:-2, 2:]
+    down_left, down_right = magnitude[2:, :-2], magnitude[2:, 2:]
+
+    directions = [
+        # 0度方向（水平エッジ）
+        ((0 <= a) & (a < 22.5)) | ((157.5 <= a) & (a <= 180)),
+        # 45度方向
+        (22.5 <= a) & (a < 67.5),
+        # 90度方向（垂直エッジ）
+        (67.5 <= a) & (a < 112.5),
+        # 135度方向
+        (112.5 <= a) & (a < 157.5),
+    ]
+    q = np.select(directions, [right, down_left, down, up_left], default=255)
+    r = np.select(directions, [left, up_right, up, down_right], default=255)
+
+    keep = (center >= q) & (center >= r)
+    result[1:-1, 1:-1] = np.where(keep, center, 0)
 
     return result
 
 
 def hysteresis_threshold(img, low, high):
     """ヒステリシス閾値処理"""
-    h, w = img.shape
-    result = np.zeros_like(img, dtype=bool)
-
     strong = img >= high
     weak = (img >= low) & (img < high)
 
-    result[strong] = True
+    # 外周の弱いエッジは追加対象外
+    weak[[0, -1], :] = False
+    weak[:, [0, -1]] = False
 
-    # 弱いエッジで強いエッジに接続しているものを追加
-    changed = True
-    while changed:
-        changed = False
-        for i in range(1, h-1):
-            for j in range(1, w-1):
-                if weak[i, j] and not result[i, j]:
-                    if np.any(result[i-1:i+2, j-1:j+2]):
-                        result[i, j] = True
-                        changed = True
+    # 強い/弱いエッジを8近傍で連結成分に分け、強いエッジを含む成分だけを残す
+    # （強いエッジからの幅優先探索と同じ結果を、画像の1回走査で得る）
+    labels, _ = ndimage.label(strong | weak, structure=np.ones((3, 3), dtype=bool))
+    connected = np.zeros(labels.max() + 1, dtype=bool)
+    connected[labels[strong]] = True
+    connected[0] = False
 
-    return result
+    return connected[labels]
 
 
 def normalize(img):
@@ -274,7 +273,7 @@ def main():
 
     # 4. DoG
     print("\n=== DoG ===")
-    dog = dog_edge(img)
+    dog = dog_edge(img, multi_scale=True)
     for name, result in dog.items():
         save_image(result, os.path.join(output_dir, f"{base_name}_dog_{name}.png"))
 
@@ -14,15 +14,15 @@ print(f"顔部分サイズ: {face.size}")
 face.save('docs/images/kirinuki_indo_face_original.png')
 
 # Sobel処理
-face_arr = np.array(face, dtype=float)
+face_arr = np.array(face, dtype=np.float32)
 
-# Sobelカーネル
-sobel_x = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]])
-sobel_y = np.array([[-1, -2, -1], [0, 0, 0], [1, 2, 1]])
+# Sobelカーネルは [1,2,1] と [-1,0,1] の外積なので1Dの2回に分解
+smooth = [1, 2, 1]
+diff = [-1, 0, 1]
 
-gx = ndimage.convolve(face_arr, sobel_x)
-gy = ndimage.convolve(face_arr, sobel_y)
-magnitude = np.sqrt(gx**2 + gy**2)
+gx = ndimage.convolve1d(ndimage.convolve1d(face_arr, smooth, axis=0), diff, axis=1)
+gy = ndimage.convolve1d(ndimage.convolve1d(face_arr, smooth, axis=1), diff, axis=0)
+magnitude = np.hypot(gx, gy)
 
 # 正規化
 magnitude = (magnitude / magnitude.max() * 255).astype(np.uint8)
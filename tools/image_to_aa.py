@@ -67,11 +67,81 @@ KANJI_SET = """
 彫刻塑像絵画描写素描輪郭陰影濃淡彩色
 """
 
-# 重複を除去してリスト化
-KANJI_LIST = list(set(KANJI_SET.replace('\n', '').replace(' ', '')))
+# 重複を除去してリスト化（出現順を保つので実行ごとに並びが変わらない）
+KANJI_LIST = list(dict.fromkeys(KANJI_SET.replace('\n', '').replace(' ', '')))
 print(f"漢字セット: {len(KANJI_LIST)}文字")
 
 
+# 輝度で文字を選択（濃度順に並べた漢字）
+# より細かい24段階グラデーション
+# 薄い→濃い: スペース→点→線→簡単な漢字→複雑な漢字→塗りつぶし
+DENSITY_CHARS = np.array([
+    '　',  # 白（透明）
+    '　',  # ほぼ白
+    '.',   # 点
+    '･',   # 中点
+    '°',   # 度
+    '゜',  # 半濁点
+    '`',   # バッククォート
+    ':',   # コロン
+    ';',   # セミコロン
+    '人',  # 簡単な漢字
+    '八',  #
+    '川',  #
+    '山',  #
+    '村',  #
+    '林',  #
+    '森',  #
+    '轟',  #
+    '響',  #
+    '鬱',  #
+    '驫',  #
+    '麟',  #
+    '龍',  #
+    '鑿',  #
+    '■',  # 塗りつぶし
+])
+
+
+# 厳密にスコアを計算する候補数（残りはスコアの上限で足切り）
+MATCH_SHORTLIST = 16
+
+# 8bit値ごとの立っているビット数（np.bitwise_count が無い NumPy 用）
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def pack_bits(bitmaps):
+    """ビットマップ (..., H, W) を64ビット単位に詰める → (..., ceil(H*W/64)) の uint64"""
+    flat = bitmaps.reshape(*bitmaps.shape[:-2], -1)
+    packed = np.packbits(flat, axis=-1)
+    pad = -packed.shape[-1] % 8
+    if pad:
+        packed = np.pad(packed, [(0, 0)] * (packed.ndim - 1) + [(0, pad)])
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def count_bits(words):
+    """最後の軸ごとに立っているビット数を数える（popcount）"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def resize_nearest(bitmap, shape):
+    """最近傍法でリサイズ（PILのNEARESTと同じく画素中心でサンプリング）"""
+    rows = (2 * np.arange(shape[0]) + 1) * bitmap.shape[0] // (2 * shape[0])
+    cols = (2 * np.arange(shape[1]) + 1) * bitmap.shape[1] // (2 * shape[1])
+    return bitmap.take(rows, axis=0).take(cols, axis=1)
+
+
+def block_counts(bitmaps, grid=8):
+    """ビットマップ (..., S, S) を grid x grid のブロックに分け、ブロックごとの画素数を数える"""
+    size = bitmaps.shape[-1]
+    edges = np.arange(min(grid, size)) * size // min(grid, size)
+    counts = np.add.reduceat(bitmaps.astype(np.int32), edges, axis=-2)
+    return np.add.reduceat(counts, edges, axis=-1)
+
+
 class ImageToAA:
     def __init__(self, char_size=128, font_path=None):
         """
@@ -81,7 +151,14 @@ class ImageToAA:
         """
         self.char_size = char_size
         self.font = self._load_font(font_path)
-        self.char_bitmaps = {}  # 文字→ビットマップのキャッシュ
+        # 文字描画用の画像（文字ごとに作らず使い回す）
+        self.canvas = Image.new('L', (char_size, char_size), 255)
+        self.draw = ImageDraw.Draw(self.canvas)
+        self.char_list = []  # マッチング候補の文字
+        self.bmp_stack = None  # 候補のビットマップ (N, S, S)（char_listと同じ並び）
+        self.packed_bitmaps = None  # 候補のビットマップを64ビット単位に詰めた (N, words) 行列
+        self.block_count_index = None  # 候補のブロックごとの黒画素数 (N, 8, 8)（block_countsの結果、候補の絞り込み用）
+        self.black_ratios = None  # 候補ごとの黒の割合 (N,)
 
     def _load_font(self, font_path):
         """フォント読み込み"""
@@ -103,37 +180,38 @@ class ImageToAA:
 
     def _char_to_bitmap(self, char):
         """文字を二値ビットマップに変換"""
-        if char in self.char_bitmaps:
-            return self.char_bitmaps[char]
-
-        # 文字を描画
-        img = Image.new('L', (self.char_size, self.char_size), 255)
-        draw = ImageDraw.Draw(img)
+        # 描画用の画像を白で塗りつぶしてから文字を描画
+        self.canvas.paste(255, (0, 0, self.char_size, self.char_size))
 
         # 文字を中央に配置
-        bbox = draw.textbbox((0, 0), char, font=self.font)
+        bbox = self.draw.textbbox((0, 0), char, font=self.font)
         w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
         x = (self.char_size - w) // 2 - bbox[0]
         y = (self.char_size - h) // 2 - bbox[1]
-        draw.text((x, y), char, font=self.font, fill=0)
+        self.draw.text((x, y), char, font=self.font, fill=0)
 
         # 二値化
-        bitmap = np.array(img) < 128
-        self.char_bitmaps[char] = bitmap
-        return bitmap
+        return np.array(self.canvas) < 128
 
     def _precompute_char_bitmaps(self, chars):
-        """全文字のビットマップを事前計算"""
+        """全文字のビットマップを事前計算（同じ文字リストなら2回目以降は作り直さない）"""
+        if self.bmp_stack is not None and self.char_list == list(chars):
+            return
+
         print(f"文字ビットマップを生成中... ({len(chars)}文字)")
-        for i, char in enumerate(chars):
-            self._char_to_bitmap(char)
+        # 全文字を1つの連続した配列に描画（i番目の文字 = bmp_stack[i]）
+        self.char_list = list(chars)
+        self.bmp_stack = np.empty((len(chars), self.char_size, self.char_size), dtype=bool)
+        for i, char in enumerate(self.char_list):
+            self.bmp_stack[i] = self._char_to_bitmap(char)
             if (i + 1) % 100 == 0:
                 print(f"  {i + 1}/{len(chars)}")
         print("完了!")
 
-        # 黒塗りつぶし・白塗りつぶしも追加
-        self.char_bitmaps['■'] = np.ones((self.char_size, self.char_size), dtype=bool)
-        self.char_bitmaps['□'] = np.zeros((self.char_size, self.char_size), dtype=bool)
+        # マッチング用の派生データ
+        self.packed_bitmaps = pack_bits(self.bmp_stack)
+        self.block_count_index = block_counts(self.bmp_stack)
+        self.black_ratios = np.count_nonzero(self.bmp_stack, axis=(1, 2)) / (self.char_size * self.char_size)
 
     def _color_condensation(self, boxel):
         """
@@ -165,43 +243,42 @@ class ImageToAA:
     def _binarize(self, boxel):
         """二値化（大津の方法）"""
         # 大津の方法で最適な閾値を計算
+        # 閾値iごとの背景/前景の画素数・輝度和を累積和で一括計算
         hist, bins = np.histogram(boxel.flatten(), bins=256, range=(0, 256))
-        total = boxel.size
-
-        sum_total = np.sum(np.arange(256) * hist)
-        sum_bg = 0
-        weight_bg = 0
-        max_variance = 0
-        threshold = 0
-
-        for i in range(256):
-            weight_bg += hist[i]
-            if weight_bg == 0:
-                continue
-            weight_fg = total - weight_bg
-            if weight_fg == 0:
-                break
-
-            sum_bg += i * hist[i]
+        levels = np.arange(256)
+
+        weight_bg = np.cumsum(hist)
+        weight_fg = boxel.size - weight_bg
+        sum_bg = np.cumsum(levels * hist)
+        sum_total = sum_bg[-1]
+
+        valid = (weight_bg > 0) & (weight_fg > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
             mean_bg = sum_bg / weight_bg
             mean_fg = (sum_total - sum_bg) / weight_fg
+            variance = np.where(valid, weight_bg * weight_fg * (mean_bg - mean_fg) ** 2, 0)
 
-            variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
-            if variance > max_variance:
-                max_variance = variance
-                threshold = i
+        # 分散が最大になる最初の閾値（全て0なら0）
+        threshold = int(np.argmax(variance))
 
         return boxel < threshold
 
-    def _match_char(self, boxel_binary, chars):
+    def _exact_scores(self, boxel_packed, indices, ratio_diffs):
+        """指定した候補のスコア（XNORの合致率 - 黒率の差のペナルティ）"""
+        size = self.char_size * self.char_size
+        # 不一致数 = XORして立っているビット数（64画素ずつ処理）
+        mismatches = count_bits(self.packed_bitmaps[indices] ^ boxel_packed)
+        matches = (size - mismatches) / size
+        return matches - ratio_diffs[indices] * 0.3
+
+    def _match_char(self, boxel_binary):
         """
         二値化されたboxelに最もマッチする文字を探す
+        （候補は_precompute_char_bitmapsに渡した文字）
         """
-        best_char = ' '
-        best_score = -1
-
         # 黒/白の割合をチェック
-        black_ratio = np.mean(boxel_binary)
+        # bool の平均を float64 で集計せず、黒画素数を整数で数えて割る
+        black_ratio = np.count_nonzero(boxel_binary) / boxel_binary.size
 
         # ほぼ真っ白ならスペース
         if black_ratio < 0.03:
@@ -213,29 +290,30 @@ class ImageToAA:
 
         # boxelをビットマップサイズにリサイズ（一度だけ）
         if boxel_binary.shape != (self.char_size, self.char_size):
-            boxel_resized = np.array(
-                Image.fromarray(boxel_binary.astype(np.uint8) * 255)
-                .resize((self.char_size, self.char_size), Image.NEAREST)
-            ) > 128
+            boxel_resized = resize_nearest(boxel_binary, (self.char_size, self.char_size))
         else:
             boxel_resized = boxel_binary
 
-        for char in chars:
-            bitmap = self.char_bitmaps.get(char)
-            if bitmap is None:
-                continue
+        size = boxel_resized.size
 
-            # 合致率（XNORの平均）
-            match = np.mean(boxel_resized == bitmap)
+        # 黒の分布も考慮（同じ黒率の文字を優先）
+        ratio_diffs = np.abs(black_ratio - self.black_ratios)
 
-            # 黒の分布も考慮（同じ黒率の文字を優先）
-            char_black_ratio = np.mean(bitmap)
-            ratio_diff = abs(black_ratio - char_black_ratio)
-            adjusted_score = match - ratio_diff * 0.3
+        # ブロックごとの黒画素数の差の合計は不一致数の下限になるので、
+        # そこからスコアの上限を安く見積もれる
+        lower_bounds = np.abs(self.block_count_index - block_counts(boxel_resized)).sum(axis=(1, 2))
+        upper_scores = (size - lower_bounds) / size - ratio_diffs * 0.3
 
-            if adjusted_score > best_score:
-                best_score = adjusted_score
-                best_char = char
+        # 上限の高い候補だけを厳密に評価し、その最良スコアに上限が届かない候補を除外
+        boxel_packed = pack_bits(boxel_resized)
+        shortlist = np.argsort(-upper_scores, kind='stable')[:MATCH_SHORTLIST]
+        threshold = self._exact_scores(boxel_packed, shortlist, ratio_diffs).max()
+        candidates = np.flatnonzero(upper_scores >= threshold)
+
+        adjusted_scores = self._exact_scores(boxel_packed, candidates, ratio_diffs)
+        best = int(np.argmax(adjusted_scores))
+        best_score = adjusted_scores[best]
+        best_char = self.char_list[candidates[best]]
 
         # 合致率が低すぎる場合
         if best_score < 0.5:
@@ -310,69 +388,27 @@ class ImageToAA:
 
         print(f"Boxelサイズ: {boxel_w}x{boxel_h}px")
 
+        # Boxelが0pxなら全て空白
+        if boxel_h == 0 or boxel_w == 0:
+            return '\n'.join(' ' * output_width for _ in range(output_height))
+
         # AA生成
-        result = []
-        for row in range(output_height):
-            line = ""
-            for col in range(output_width):
-                # Boxel切り出し
-                y1 = row * boxel_h
-                y2 = min(y1 + boxel_h, h)
-                x1 = col * boxel_w
-                x2 = min(x1 + boxel_w, w)
-
-                boxel = img_array[y1:y2, x1:x2]
-
-                if boxel.size == 0:
-                    line += ' '
-                    continue
-
-                # 平均輝度を計算
-                avg_brightness = np.mean(boxel)
-
-                # 輝度で文字を選択（濃度順に並べた漢字）
-                # より細かい24段階グラデーション
-                # 薄い→濃い: スペース→点→線→簡単な漢字→複雑な漢字→塗りつぶし
-                DENSITY_CHARS = [
-                    '　',  # 白（透明）
-                    '　',  # ほぼ白
-                    '.',   # 点
-                    '･',   # 中点
-                    '°',   # 度
-                    '゜',  # 半濁点
-                    '`',   # バッククォート
-                    ':',   # コロン
-                    ';',   # セミコロン
-                    '人',  # 簡単な漢字
-                    '八',  #
-                    '川',  #
-                    '山',  #
-                    '村',  #
-                    '林',  #
-                    '森',  #
-                    '轟',  #
-                    '響',  #
-                    '鬱',  #
-                    '驫',  #
-                    '麟',  #
-                    '龍',  #
-                    '鑿',  #
-                    '■',  # 塗りつぶし
-                ]
-
-                # 輝度を0-23のインデックスにマッピング
-                # 高輝度（白）= 0、低輝度（黒）= 23
-                idx = int((255 - avg_brightness) / 256 * len(DENSITY_CHARS))
-                idx = max(0, min(len(DENSITY_CHARS) - 1, idx))
-                char = DENSITY_CHARS[idx]
-
-                line += char
-
-            result.append(line)
-            if (row + 1) % 10 == 0:
-                print(f"進捗: {row + 1}/{output_height}行")
-
-        return '\n'.join(result)
+        # 画像を (行, boxel_h, 列, boxel_w) のブロックに分け、輝度の合計を一括計算
+        blocks = img_array[:output_height * boxel_h, :output_width * boxel_w].reshape(
+            output_height, boxel_h, output_width, boxel_w
+        )
+        block_sums = blocks.sum(axis=(1, 3), dtype=np.int64)
+
+        # 輝度を0-23のインデックスにマッピングして文字を引く
+        # 高輝度（白）= 0、低輝度（黒）= 23
+        # int((255 - 平均輝度) / 256 * 24) を、平均を取らずに整数のまま計算する
+        # （平均が境界ちょうどのときも浮動小数点の誤差で隣の段階にずれない）
+        n = boxel_h * boxel_w
+        levels = len(DENSITY_CHARS)
+        idx = np.clip((255 * n - block_sums) * levels // (256 * n), 0, levels - 1)
+        chars = DENSITY_CHARS[idx]
+
+        return '\n'.join(''.join(line) for line in chars)
 
 
 def main():
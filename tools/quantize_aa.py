@@ -5,9 +5,13 @@ AAテキストを量子化（高解像度AA → 低解像度AA）
 """
 
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from PIL import Image, ImageDraw, ImageFont
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 import os
 import sys
+import tempfile
+import zipfile
 
 
 # 漢字セット（aa_pattern_match.pyと同じ）
@@ -30,7 +34,41 @@ KANJI_SET = """
 光影陰陽明暗昼夜朝晩
 """
 
-KANJI_LIST = list(set(KANJI_SET.replace('\n', '').replace(' ', '')))
+KANJI_LIST = list(dict.fromkeys(KANJI_SET.replace('\n', '').replace(' ', '')))
+
+
+# ビットマップキャッシュの形式（create_char_bitmaps の処理を変えたら上げる）
+CACHE_VERSION = 2
+
+# 白画素数の近い順にまず評価する候補数（残りは上界で枝刈り）
+MATCH_WINDOW = 16
+
+# 8bit値ごとの立っているビット数（np.bitwise_count が無い NumPy 用）
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def pack_bits(bitmaps):
+    """ビットマップ (..., H, W) を64ビット単位に詰める → (..., ceil(H*W/64)) の uint64"""
+    flat = bitmaps.reshape(*bitmaps.shape[:-2], -1)
+    packed = np.packbits(flat, axis=-1)
+    pad = -packed.shape[-1] % 8
+    if pad:
+        packed = np.pad(packed, [(0, 0)] * (packed.ndim - 1) + [(0, pad)])
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def count_bits(words):
+    """最後の軸ごとに立っているビット数を数える（popcount）"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def resize_nearest(bitmap, shape):
+    """最近傍法で末尾2軸をリサイズ（PILのNEARESTと同じく画素中心でサンプリング）"""
+    rows = (2 * np.arange(shape[0]) + 1) * bitmap.shape[-2] // (2 * shape[0])
+    cols = (2 * np.arange(shape[1]) + 1) * bitmap.shape[-1] // (2 * shape[1])
+    return bitmap.take(rows, axis=-2).take(cols, axis=-1)
 
 
 def load_font(size):
@@ -47,87 +85,281 @@ def load_font(size):
     return ImageFont.load_default()
 
 
-def create_char_bitmap(char, size, font, bold=False):
-    """文字を二値ビットマップに変換（boldで太くする）"""
-    img = Image.new('L', (size, size), 0)
-    draw = ImageDraw.Draw(img)
+def binary_dilate3x3(bitmaps):
+    """二値ビットマップ (..., H, W) の3x3膨張（範囲外は0、縦→横の2回のずらしORで計算）
 
-    bbox = draw.textbbox((0, 0), char, font=font)
-    w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
-    x = (size - w) // 2 - bbox[0]
-    y = (size - h) // 2 - bbox[1]
-    draw.text((x, y), char, font=font, fill=255)
+    最大値は単調なので、MaxFilter(3) をかけてから二値化するのと同じ結果になる
+    """
+    out = bitmaps.copy()
+    out[..., 1:, :] |= bitmaps[..., :-1, :]
+    out[..., :-1, :] |= bitmaps[..., 1:, :]
+    rows = out.copy()
+    out[..., :, 1:] |= rows[..., :, :-1]
+    out[..., :, :-1] |= rows[..., :, 1:]
+    return out
 
-    if bold:
-        # 膨張処理で太くする
-        img = img.filter(ImageFilter.MaxFilter(3))
 
-    return np.array(img) > 128
+def create_char_bitmaps(chars, size, font, bold=False):
+    """文字列を二値ビットマップ (N, size, size) に変換（boldで太くする）
+
+    全文字を横に並べた1枚の画像（アトラス）に描画し、膨張処理も全文字まとめて行う
+    """
+    # 文字同士がはみ出し合わないよう、各文字の右に size 幅の余白を空ける
+    pitch = size * 2
+    atlas = Image.new('L', (len(chars) * pitch, size), 0)
+    draw = ImageDraw.Draw(atlas)
+
+    for i, char in enumerate(chars):
+        bbox = draw.textbbox((0, 0), char, font=font)
+        w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        x = i * pitch + (size - w) // 2 - bbox[0]
+        y = (size - h) // 2 - bbox[1]
+        draw.text((x, y), char, font=font, fill=255)
 
+    # 各文字の枠だけを切り出す（余白にはみ出した部分は1文字ずつ描画したときに枠外で切れる部分）
+    arr = np.array(atlas).reshape(size, len(chars), pitch)
+    bitmaps = np.ascontiguousarray(arr[:, :, :size].transpose(1, 0, 2)) > 128
 
-def render_aa_to_image(aa_lines, char_size, font):
-    """AAテキストを画像にレンダリング"""
+    if bold:
+        # 膨張処理で太くする（二値化したあとにnumpy上で処理）
+        bitmaps = binary_dilate3x3(bitmaps)
+
+    return bitmaps
+
+
+def load_char_bitmaps(chars, size, font, bold=False):
+    """create_char_bitmaps の結果をディスクにキャッシュして読み込む
+
+    キャッシュは文字列・サイズ・フォント（パスと更新日時）ごとに tools/ 以下に保存する。
+    パスを持たないフォント（load_default）の場合はキャッシュしない。
+    キャッシュは高速化のためだけのものなので、読めなければ作り直し、保存できなければ諦める
+    """
+    font_path = getattr(font, 'path', None)
+    if not isinstance(font_path, str) or not os.path.exists(font_path):
+        return create_char_bitmaps(chars, size, font, bold)
+
+    key_source = repr((
+        CACHE_VERSION, ''.join(chars), size, bold, font_path, font.size, os.path.getmtime(font_path)
+    ))
+    key = hashlib.md5(key_source.encode('utf-8')).hexdigest()[:16]
+    cache_dir = os.path.dirname(os.path.abspath(__file__))
+    cache_path = os.path.join(cache_dir, f'.aa_cache_{size}_{key}.npz')
+
+    # 無い・壊れている（途中で中断された等）場合はキャッシュなしとして作り直す
+    try:
+        with np.load(cache_path) as cache:
+            return cache['bitmaps']
+    except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+        pass
+
+    bitmaps = create_char_bitmaps(chars, size, font, bold)
+
+    # 一時ファイルに書いてから置き換える（同時実行や中断で書きかけのファイルを読ませない）
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=f'.aa_cache_{size}_{key}_', suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, bitmaps=bitmaps)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            os.remove(tmp_path)
+            raise
+    except OSError:
+        pass
+    return bitmaps
+
+
+def render_glyph(char, font, char_size):
+    """1文字をラスタライズし、セル中央に置いたときの字形と位置を返す
+
+    Returns:
+        (二値化済みの字形 (gh, gw) bool, セル左上からのx, セル左上からのy)
+    """
+    bbox = font.getbbox(char)
+    if hasattr(font, 'getmask2'):
+        mask, offset = font.getmask2(char, mode='L')
+    else:
+        mask, offset = font.getmask(char, mode='L'), (0, 0)
+    glyph = np.array(mask, dtype=np.uint8).reshape(mask.size[1], mask.size[0]) > 128
+    # draw.text と同じ配置（bboxで中央寄せし、マスクのオフセットを足す）
+    dx = (char_size - (bbox[2] - bbox[0])) // 2 - bbox[0] + offset[0]
+    dy = (char_size - (bbox[3] - bbox[1])) // 2 - bbox[1] + offset[1]
+    return glyph, dx, dy
+
+
+def render_aa_to_image(aa_lines, char_size, font, width=None, glyph_cache=None):
+    """AAテキストを画像にレンダリング
+
+    Args:
+        width: 画像の幅（文字数）。省略時は最長の行に合わせる
+        glyph_cache: 字形のキャッシュ（呼び出しをまたいで使い回す場合に渡す）
+    """
     height = len(aa_lines)
-    width = max(len(line) for line in aa_lines)
+    if width is None:
+        width = max(len(line) for line in aa_lines)
+
+    # グレースケールを経由せず、二値化済みの字形を直接ORで重ねる
+    img = np.zeros((height * char_size, width * char_size), dtype=bool)
 
-    img = Image.new('L', (width * char_size, height * char_size), 0)
-    draw = ImageDraw.Draw(img)
+    # 文字ごとの字形のキャッシュ（同じ文字が何度も出てくるので1回だけラスタライズ・二値化）
+    if glyph_cache is None:
+        glyph_cache = {}
 
     for row, line in enumerate(aa_lines):
         for col, char in enumerate(line):
             if char == '　' or char == ' ':
                 continue
-            x = col * char_size
-            y = row * char_size
-            # 文字を中央に配置
-            bbox = draw.textbbox((0, 0), char, font=font)
-            cx = x + (char_size - (bbox[2] - bbox[0])) // 2 - bbox[0]
-            cy = y + (char_size - (bbox[3] - bbox[1])) // 2 - bbox[1]
-            draw.text((cx, cy), char, font=font, fill=255)
-
-    return np.array(img) > 128
-
-
-def pattern_match(cell, char_bitmaps):
-    """セルと最もマッチする漢字を探す（XNOR：白同士も黒同士も評価）"""
-    best_char = '　'
-    best_score = -1
-
-    cell_white_ratio = cell.mean()
-
-    if cell_white_ratio < 0.02:
-        return '　'
-
-    if cell_white_ratio > 0.95:
-        return '■'
-
-    for char, bitmap in char_bitmaps.items():
-        if char in ['　', '■']:
-            continue
-
-        # リサイズ
-        if cell.shape != bitmap.shape:
-            cell_resized = np.array(
-                Image.fromarray(cell.astype(np.uint8) * 255)
-                .resize(bitmap.shape[::-1], Image.NEAREST)
-            ) > 128
-        else:
-            cell_resized = cell
-
-        # XNOR：白同士も黒同士も一致として評価
-        match = np.mean(cell_resized == bitmap)
-
-        # 白の割合も考慮
-        bitmap_white_ratio = bitmap.mean()
-        ratio_penalty = abs(cell_white_ratio - bitmap_white_ratio) * 0.3
-
-        score = match - ratio_penalty
-
-        if score > best_score:
-            best_score = score
-            best_char = char
-
-    return best_char
+            cached = glyph_cache.get(char)
+            if cached is None:
+                cached = glyph_cache[char] = render_glyph(char, font, char_size)
+            glyph, dx, dy = cached
+
+            # 画像からはみ出す部分は切り落として重ねる
+            top = row * char_size + dy
+            left = col * char_size + dx
+            y0, y1 = max(top, 0), min(top + glyph.shape[0], img.shape[0])
+            x0, x1 = max(left, 0), min(left + glyph.shape[1], img.shape[1])
+            if y0 >= y1 or x0 >= x1:
+                continue
+            img[y0:y1, x0:x1] |= glyph[y0 - top:y1 - top, x0 - left:x1 - left]
+
+    return img
+
+
+def source_line_range(y0, y1, char_size, num_lines):
+    """画像の y0～y1 行目に字形がかかりうる入力行の範囲 (first, last)
+
+    その範囲にかかる入力行と、はみ出しを考慮した上下1行ずつ
+    （字形は隣の行より先まではみ出さない）。
+    """
+    first = max(y0 // char_size - 1, 0)
+    last = min(-(-y1 // char_size) + 1, num_lines)
+    return first, last
+
+
+def render_aa_rows(aa_lines, y0, y1, width, char_size, font, glyph_cache=None):
+    """AA全体を描いたときの画像の y0～y1 行目だけをレンダリング"""
+    first, last = source_line_range(y0, y1, char_size, len(aa_lines))
+    img = render_aa_to_image(aa_lines[first:last], char_size, font, width, glyph_cache)
+    offset = first * char_size
+    return img[y0 - offset:y1 - offset]
+
+
+def pattern_match(cells, cell_white_counts, chars, packed_bitmaps, white_counts, char_ranks, bitmap_shape):
+    """セルごとに最もマッチする漢字を探す（XNOR：白同士も黒同士も評価）
+
+    1行分のセルをまとめて配列演算で処理し、セルごとのPython処理を挟まない。
+
+    Args:
+        cells: 二値化済みのセル (n, cell_h, cell_w)
+        cell_white_counts: 各セルの白画素数 (n,)
+        chars: 候補の漢字リスト（白画素数の昇順、packed_bitmapsの並びと対応）
+        packed_bitmaps: 全候補のビットマップをpack_bitsで詰めたもの (K, words)
+        white_counts: 各ビットマップの白画素数 (K,) int32（昇順）
+        char_ranks: 各候補の KANJI_LIST 上の位置 (K,)（同点なら先の文字を選ぶ）
+        bitmap_shape: 判定用ビットマップの (H, W)
+
+    Returns:
+        各セルの文字のリスト
+    """
+    cell_white_counts = np.asarray(cell_white_counts, dtype=np.int64)
+    cell_pixels = cells.shape[1] * cells.shape[2]
+    cell_white_ratios = cell_white_counts / cell_pixels
+    result = np.where(cell_white_ratios < 0.02, '　', np.where(cell_white_ratios > 0.95, '■', '')).tolist()
+
+    targets = np.flatnonzero((cell_white_ratios >= 0.02) & (cell_white_ratios <= 0.95))
+    if len(targets) == 0:
+        return result
+
+    # リサイズ（全候補で同じサイズなので一度だけ）
+    cells_resized = cells[targets]
+    if cells.shape[1:] != bitmap_shape:
+        cells_resized = resize_nearest(cells_resized, bitmap_shape)
+
+    # XNOR：白同士も黒同士も一致として評価
+    # 一致数 = 全画素数 - XORで立っているビット数（全候補を一括、64画素ずつ処理）
+    # スコア = 一致率 - |白の割合の差| * 0.3 を 10 * セル画素数 * 全画素数 倍して整数のまま計算
+    # （順位は変わらず、浮動小数点の丸めで同点の判定がぶれない）
+    total_bits = bitmap_shape[0] * bitmap_shape[1]
+    cells_packed = pack_bits(cells_resized)[:, None, :]
+    cell_targets = cell_white_counts[targets, None] * total_bits
+    scale = 10 * cell_pixels
+
+    def score(indices):
+        # indices はスライスでも添字配列でもよい（スライスなら行列の連続した行をコピーせずに読む）
+        agrees = total_bits - count_bits(packed_bitmaps[indices] ^ cells_packed)
+        ratio_penalties = 3 * np.abs(cell_targets - white_counts[indices] * np.int64(cell_pixels))
+        return scale * agrees - ratio_penalties
+
+    # まずリサイズ後のセルと白画素数が近い候補だけ評価
+    window = min(MATCH_WINDOW, len(chars))
+    resized_counts = np.count_nonzero(cells_resized, axis=(1, 2))
+    centers = np.searchsorted(white_counts, resized_counts)
+    hi = np.minimum(np.maximum(centers + window // 2, window), len(chars))
+    lo = hi - window
+    best = score(lo[:, None] + np.arange(window)).max(axis=1)
+
+    # 一致数は 全画素数 - |白画素数の差| を超えず、白の割合の罰則も一致数の上限を超えられないので、
+    # best に届きうる候補は白画素数の帯の中だけ（昇順なので二分探索で範囲が決まる）
+    margin = total_bits + best // -scale
+    slack = (scale * total_bits - best) // 3
+    band_lo = np.maximum(resized_counts - margin, -((slack - cell_targets[:, 0]) // cell_pixels))
+    band_hi = np.minimum(resized_counts + margin, (cell_targets[:, 0] + slack) // cell_pixels)
+    band_lo = np.minimum(np.searchsorted(white_counts, band_lo, side='left'), lo).min()
+    band_hi = np.maximum(np.searchsorted(white_counts, band_hi, side='right'), hi).max()
+
+    # 行内の全セルの帯をまとめた範囲だけを評価（範囲外の候補は最大スコアに届かない）
+    scores = score(slice(band_lo, band_hi))
+    ranks = np.where(scores == scores.max(axis=1, keepdims=True), char_ranks[band_lo:band_hi], len(chars))
+    for target, pick in zip(targets, np.argmin(ranks, axis=1) + band_lo):
+        result[target] = chars[pick]
+    return result
+
+
+# ワーカープロセスが使う候補データと入力AA（initializerで1回だけ受け取り、行ごとに送らない）
+_worker_candidates = {}
+_worker_source = {}
+
+
+def init_worker(chars, packed_bitmaps, white_counts, char_ranks, bitmap_shape,
+                aa_lines, char_size, cell_shape, output_width):
+    """ワーカープロセスの初期化"""
+    _worker_candidates.update(
+        chars=chars,
+        packed_bitmaps=packed_bitmaps,
+        white_counts=white_counts,
+        char_ranks=char_ranks,
+        bitmap_shape=bitmap_shape,
+    )
+    _worker_source.update(
+        aa_lines=aa_lines,
+        width=max(len(line) for line in aa_lines),
+        char_size=char_size,
+        font=load_font(char_size),
+        glyph_cache={},
+        cell_shape=cell_shape,
+        output_width=output_width,
+    )
+
+
+def match_row(row):
+    """1行分のセルをマッチングして文字列にする
+
+    AA全体の画像は作らず、この行のセルにかかる部分だけをレンダリングする。
+    """
+    src = _worker_source
+    cell_h, cell_w = src['cell_shape']
+    strip = render_aa_rows(
+        src['aa_lines'], row * cell_h, (row + 1) * cell_h,
+        src['width'], src['char_size'], src['font'], src['glyph_cache']
+    )[:, :src['output_width'] * cell_w]
+
+    # 各セルの白画素数は列方向の和をセル幅ごとにまとめて求める
+    cell_white_counts = np.add.reduceat(
+        np.count_nonzero(strip, axis=0), np.arange(src['output_width']) * cell_w
+    )
+    cells = strip.reshape(cell_h, -1, cell_w).swapaxes(0, 1)
+    return ''.join(pattern_match(cells, cell_white_counts, **_worker_candidates))
 
 
 def main():
@@ -147,16 +379,15 @@ def main():
     print(f"入力AAサイズ: {input_width}x{input_height}文字")
 
     # 文字サイズ（レンダリング用）
+    # 画像全体は作らず、ワーカーが担当する行の分だけレンダリングする
     char_size = 16  # 各文字を16x16pxでレンダリング
-    font = load_font(char_size)
-
-    print("AAを画像にレンダリング中...")
-    aa_image = render_aa_to_image(aa_lines, char_size, font)
-    print(f"レンダリング画像サイズ: {aa_image.shape[1]}x{aa_image.shape[0]}px")
+    image_h = input_height * char_size
+    image_w = input_width * char_size
+    print(f"レンダリング画像サイズ: {image_w}x{image_h}px")
 
     # セルサイズ
-    cell_h = aa_image.shape[0] // output_height
-    cell_w = aa_image.shape[1] // output_width
+    cell_h = image_h // output_height
+    cell_w = image_w // output_width
     print(f"セルサイズ: {cell_w}x{cell_h}px")
 
     # 判定用ビットマップ（太字）
@@ -164,34 +395,42 @@ def main():
     match_font = load_font(match_char_size)
 
     print(f"判定用ビットマップ生成中（太字、サイズ: {match_char_size}x{match_char_size}）...")
-    char_bitmaps_bold = {}
-    for char in KANJI_LIST:
-        char_bitmaps_bold[char] = create_char_bitmap(char, match_char_size, match_font, bold=True)
-
-    char_bitmaps_bold['　'] = np.zeros((match_char_size, match_char_size), dtype=bool)
-    char_bitmaps_bold['■'] = np.ones((match_char_size, match_char_size), dtype=bool)
+    chars = KANJI_LIST
+    bitmap_stack = load_char_bitmaps(chars, match_char_size, match_font, bold=True)
+
+    # 全候補を (K, words) の行列に詰め、白画素数と合わせて事前計算
+    # 白画素数の昇順に並べ替えておき、セルごとに二分探索で評価範囲を絞る
+    white_counts = np.count_nonzero(bitmap_stack, axis=(1, 2)).astype(np.int32)
+    char_ranks = np.argsort(white_counts, kind='stable')
+    chars = [chars[i] for i in char_ranks]
+    packed_bitmaps = pack_bits(bitmap_stack)[char_ranks]
+    white_counts = white_counts[char_ranks]
+    bitmap_shape = (match_char_size, match_char_size)
 
     print("量子化中...")
     result = []
-    for row in range(output_height):
-        line = ""
-        for col in range(output_width):
-            y1 = row * cell_h
-            y2 = min(y1 + cell_h, aa_image.shape[0])
-            x1 = col * cell_w
-            x2 = min(x1 + cell_w, aa_image.shape[1])
-
-            cell = aa_image[y1:y2, x1:x2]
-
-            if cell.size == 0:
-                line += '　'
-                continue
-
-            char = pattern_match(cell, char_bitmaps_bold)
-            line += char
-
-        result.append(line)
-        print(f"進捗: {row + 1}/{output_height}行")
+    if cell_h == 0 or cell_w == 0:
+        result = ['　' * output_width] * output_height
+    else:
+        # 字形がかかりうる入力行が空白だけの出力行は、レンダリングもマッチングもせず全角スペースにする
+        blank_lines = [line.strip(' 　') == '' for line in aa_lines]
+        blank_rows = [
+            all(blank_lines[slice(*source_line_range(
+                row * cell_h, (row + 1) * cell_h, char_size, input_height
+            ))])
+            for row in range(output_height)
+        ]
+
+        # 各行は独立なので、行単位でCPUコアに振り分ける
+        with ProcessPoolExecutor(
+            initializer=init_worker,
+            initargs=(chars, packed_bitmaps, white_counts, char_ranks, bitmap_shape,
+                      aa_lines, char_size, (cell_h, cell_w), output_width),
+        ) as executor:
+            matched = executor.map(match_row, [row for row in range(output_height) if not blank_rows[row]])
+            for row in range(output_height):
+                result.append('　' * output_width if blank_rows[row] else next(matched))
+                print(f"進捗: {row + 1}/{output_height}行")
 
     aa_text = '\n'.join(result)
 